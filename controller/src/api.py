@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import json
+from http.cookiejar import DefaultCookiePolicy
 from typing import List, Optional, Tuple, Union
 
 import requests
@@ -19,6 +20,8 @@ from fastapi import (APIRouter, Depends, FastAPI, File, Header, Request,
                      UploadFile)
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from controller.src.config import config
 from controller.src.model import ChatSession, DocCollection, OutputMode, User, QueryItem
@@ -39,6 +42,18 @@ app.add_middleware(
 # Create a router with a prefix
 router = APIRouter(prefix="/api")
 
+# Reuse the connections (keep-alive) for all the requests sent to the application
+_http_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.1),
+)
+_http = requests.Session()
+# the session is shared by all the users, never store and replay cookies
+_http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+_http.mount("http://", _http_adapter)
+_http.mount("https://", _http_adapter)
+
 
 def get_db():
     db_session = None
@@ -88,7 +103,7 @@ def _send_to_application(path: str, method: str = "POST", request=None, auth=Non
     if auth is not None:
         kwargs["headers"] = {"x_username": auth.username}
 
-    response = requests.request(
+    response = _http.request(
         method=method,
         url=url,
         **kwargs,
@@ -176,10 +191,17 @@ def list_users(
     email: str = None,
     username: str = None,
     mode: OutputMode = OutputMode.Details,
+    limit: int = 0,
+    offset: int = 0,
     session=Depends(get_db),
 ):
     return client.list_users(
-        email=email, full_name=username, output_mode=mode, session=session
+        email=email,
+        full_name=username,
+        output_mode=mode,
+        session=session,
+        limit=limit,
+        offset=offset,
     )
 
 
@@ -208,12 +230,18 @@ def delete_user(username: str, session=Depends(get_db)):
 def list_user_sessions(
     username: str,
     last: int = 0,
+    offset: int = 0,
     created: str = None,
     mode: OutputMode = OutputMode.Details,
     session=Depends(get_db),
 ):
     return client.list_sessions(
-        username, created_after=created, last=last, output_mode=mode, session=session
+        username,
+        created_after=created,
+        last=last,
+        output_mode=mode,
+        session=session,
+        offset=offset,
     )
 
 
@@ -236,6 +264,7 @@ def create_session(chat_session: ChatSession, session=Depends(get_db)):
 async def list_sessions(
     username: str = None,
     last: int = 0,
+    offset: int = 0,
     created: str = None,
     mode: OutputMode = OutputMode.Details,
     session=Depends(get_db),
@@ -243,7 +272,12 @@ async def list_sessions(
 ):
     user = None if username and username == "all" else (username or auth.username)
     return client.list_sessions(
-        user, created_after=created, last=last, output_mode=mode, session=session
+        user,
+        created_after=created,
+        last=last,
+        output_mode=mode,
+        session=session,
+        offset=offset,
     )
 
 
@@ -17,9 +17,11 @@
 import json
 
 import click
+import orjson
 import yaml
 from tabulate import tabulate
 
+from controller.src import sqldb
 from controller.src.sqlclient import client
 from controller.src.model import User, DocCollection, QueryItem
 from controller.src.config import config
@@ -36,26 +38,27 @@ def cli():
 def initdb():
     """Initialize the database (delete old tables)"""
     click.echo("Running Init DB")
-    session = client.get_db_session()
     client.create_tables(True)
-    # create a guest user, and the default document collection
-    client.create_user(
-        User(
-            name="guest",
-            email="guest@any.com",
-            full_name="Guest User",
-        ),
-        session=session,
+    # create a guest user, and the default document collection (single transaction)
+    guest = User(
+        name="guest",
+        email="guest@any.com",
+        full_name="Guest User",
     )
-    client.create_collection(
-        DocCollection(
-            name="default",
-            description="Default Collection",
-            owner_name="guest",
-            category="vector",
-        ),
-        session=session,
+    collection = DocCollection(
+        name="default",
+        description="Default Collection",
+        owner_name=guest.name,
+        category="vector",
     )
+    session = client.get_db_session()
+    with session.begin():
+        session.add_all(
+            [
+                guest.to_orm_object(sqldb.User),
+                collection.to_orm_object(sqldb.DocumentCollection),
+            ]
+        )
     session.close()
 
 
@@ -126,7 +129,7 @@ def query(question, filter, collection, user, session, pipeline_name):
         filter=search_args,
         collection=collection,
     )
-    data = json.dumps(query_item.dict())
+    data = orjson.dumps(query_item.dict())
 
     headers = {"x_username": user} if user else {}
     response = api._send_to_application(
@@ -155,12 +158,16 @@ def update():
 @click.command("users")
 @click.option("-u", "--user", type=str, help="user name filter")
 @click.option("-e", "--email", type=str, help="email filter")
-def list_users(user, email):
+@click.option("-l", "--limit", type=int, default=0, help="max number of users")
+@click.option("--offset", type=int, default=0, help="number of users to skip")
+def list_users(user, email, limit, offset):
     """List users"""
     click.echo("Running List Users")
 
-    data = client.list_users(email, user, output_mode="short")
-    table = format_table_results(data)
+    data = client.list_users(
+        email, user, output_mode="short", limit=limit, offset=offset
+    ).with_raise()
+    table = format_table_results(data.data)
     click.echo(table)
 
 
@@ -174,8 +181,8 @@ def list_collections(owner, metadata):
     """List document collections"""
     click.echo("Running List Collections")
 
-    data = client.list_collections(owner, metadata, output_mode="short")
-    table = format_table_results(data)
+    data = client.list_collections(owner, metadata, output_mode="short").with_raise()
+    table = format_table_results(data.data)
     click.echo(table)
 
 
@@ -220,12 +227,15 @@ def update_collection(name, owner, description, category, labels):
 @click.option("-u", "--user", type=str, help="user name filter")
 @click.option("-l", "--last", type=int, default=0, help="last n sessions")
 @click.option("-c", "--created", type=str, help="created after date")
-def list_sessions(user, last, created):
+@click.option("--offset", type=int, default=0, help="number of sessions to skip")
+def list_sessions(user, last, created, offset):
     """List chat sessions"""
     click.echo("Running List Sessions")
 
-    data = client.list_sessions(user, created, last, output_mode="short")
-    table = format_table_results(data["data"])
+    data = client.list_sessions(
+        user, created, last, output_mode="short", offset=offset
+    ).with_raise()
+    table = format_table_results(data.data)
     click.echo(table)
 
 
@@ -242,21 +252,26 @@ def sources_to_md(sources):
     """Convert a list of sources to a Markdown string."""
     if not sources:
         return ""
-    sources = {
-        source.metadata["source"]: get_title(source.metadata) for source in sources
-    }
+    titles = {}
+    for source in sources:
+        url = source.metadata["source"]
+        if url not in titles:
+            titles[url] = get_title(source.metadata)
     return "\n**Source documents:**\n" + "\n".join(
-        f"- [{title}]({url})" for url, title in sources.items()
+        f"- [{title}]({url})" for url, title in titles.items()
     )
 
 
 def get_title(metadata):
     """Get title from metadata."""
-    if "chunk" in metadata:
-        return f"{metadata.get('title', '')}-{metadata['chunk']}"
-    if "page" in metadata:
-        return f"{metadata.get('title', '')} - page {metadata['page']}"
-    return metadata.get("title", "")
+    title = metadata.get("title", "")
+    chunk = metadata.get("chunk")
+    if chunk is not None:
+        return f"{title}-{chunk}"
+    page = metadata.get("page")
+    if page is not None:
+        return f"{title} - page {page}"
+    return title
 
 
 def fill_params(params, params_dict=None):
@@ -275,7 +290,13 @@ def fill_params(params, params_dict=None):
 
 
 def format_table_results(table_results):
-    return tabulate(table_results, headers="keys", tablefmt="fancy_grid")
+    if not table_results:
+        return "(no results)"
+    # rows may omit empty fields, so collect the union of keys (in first-seen order),
+    # unpacked since `list` is the click group in this module
+    headers = [*dict.fromkeys(key for row in table_results for key in row)]
+    rows = [[row.get(key) for key in headers] for row in table_results]
+    return tabulate(rows, headers=headers, tablefmt="simple")
 
 
 cli.add_command(ingest)
@@ -14,12 +14,15 @@
 
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache
 from http.client import HTTPException
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union, get_args
 
 import yaml
 from pydantic import BaseModel
 
+from controller.src.sqldb import update_labels
+
 
 # ============================== from llmapps/app/schema.py ==============================
 # Temporary: This was copied to here to avoid import from the app like this:
@@ -70,17 +73,25 @@ class Conversation(BaseModel):
         self.messages.append(Message(role=role, content=content, sources=sources))
 
     def to_list(self):
-        return self.dict()["messages"]
-        # return self.model_dump(mode="json")["messages"]
+        return [message.dict() for message in self.messages]
+        # return [message.model_dump(mode="json") for message in self.messages]
 
     def to_dict(self):
-        return self.dict()["messages"]
-        # return self.model_dump(mode="json")["messages"]
+        return self.to_list()
 
     @classmethod
     def from_list(cls, data: list):
-        return cls.parse_obj({"messages": data or []})
-        # return cls.model_validate({"messages": data or []})
+        # the history is loaded from the DB and was validated when stored
+        messages = []
+        for message in data or []:
+            if isinstance(message, dict):
+                fields = {k: v for k, v in message.items() if k in Message.__fields__}
+                if "role" in fields:
+                    fields["role"] = ChatRole(fields["role"])
+                message = Message.construct(**fields)
+            messages.append(message)
+        return cls.construct(messages=messages, saved_index=0)
+        # return cls.model_construct(messages=messages, saved_index=0)
 
 
 class QueryItem(BaseModel):
@@ -104,6 +115,17 @@ metadata_fields = [
 ]
 
 
+def _field_has_type(field, field_type) -> bool:
+    """Check if a pydantic field is declared as (or as a union including) the type."""
+    types = (field.type_,) + get_args(field.type_)
+    return any(isinstance(t, type) and issubclass(t, field_type) for t in types)
+
+
+@lru_cache(maxsize=None)
+def _orm_columns(db_class) -> tuple:
+    return tuple(column.name for column in db_class.__table__.columns)
+
+
 class Base(BaseModel):
     _extra_fields = []
     _top_level_fields = []
@@ -111,94 +133,109 @@ class Base(BaseModel):
     class Config:
         orm_mode = True
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # precompute the per-class field sets used on every (de)serialization
+        cls._metadata_set = frozenset(metadata_fields)
+        cls._extra_set = frozenset(cls._extra_fields)
+        cls._top_set = frozenset(cls._top_level_fields)
+        # fields stored as table columns (the rest go into the spec column)
+        cls._non_spec_set = cls._metadata_set | cls._top_set
+        cls._persisted_set = cls._non_spec_set - {"created", "updated"}
+        cls._short_spec_fields = (
+            frozenset(cls.__fields__) - cls._non_spec_set - cls._extra_set
+        )
+        cls._datetime_fields = frozenset(
+            name for name, f in cls.__fields__.items() if _field_has_type(f, datetime)
+        )
+        cls._model_fields = frozenset(
+            name for name, f in cls.__fields__.items() if _field_has_type(f, BaseModel)
+        )
+        cls._nested_fields = frozenset(
+            name for name, f in cls.__fields__.items() if _field_has_type(f, Base)
+        )
+
     def to_dict(
         self, drop_none=True, short=False, drop_metadata=False, to_datestr=False
     ):
-        struct = self.dict()
-        # struct = self.model_dump(mode="json")  # pydantic v2
+        values = self.__dict__
         new_struct = {}
-        for k, v in struct.items():
+        for k in self.__fields__:
+            v = values.get(k)
             if (
                 (drop_none and v is None)
-                or (short and k in self._extra_fields)
-                or (drop_metadata and k in metadata_fields)
+                or (short and k in self._extra_set)
+                or (drop_metadata and k in self._metadata_set)
             ):
                 continue
-            if to_datestr and isinstance(v, datetime):
-                v = v.isoformat()
-            elif short and isinstance(v, datetime):
-                v = v.strftime("%Y-%m-%d %H:%M")
-            if hasattr(v, "to_dict"):
-                v = v.to_dict()
+            if k in self._datetime_fields and isinstance(v, datetime):
+                if to_datestr:
+                    v = v.isoformat()
+                elif short:
+                    v = v.strftime("%Y-%m-%d %H:%M")
+            elif k in self._nested_fields and isinstance(v, Base):
+                v = v.to_dict(drop_none, short, drop_metadata, to_datestr)
+            elif k in self._model_fields and v is not None:
+                v = _model_to_dict(v)
+            elif isinstance(v, dict):
+                # copy the containers, the result must not share state with the model
+                v = dict(v)
+            elif isinstance(v, list):
+                v = list(v)
             new_struct[k] = v
         return new_struct
 
     @classmethod
-    def from_dict(cls, data: dict):
+    def from_dict(cls, data: dict, trusted: bool = False):
         if isinstance(data, cls):
             return data
+        if trusted:
+            # skip validation for data which is already known to be valid (e.g. DB)
+            return cls.construct(
+                **{k: v for k, v in data.items() if k in cls.__fields__}
+            )
+            # return cls.model_construct(...)  # pydantic v2
         return cls.parse_obj(data)
         # return cls.model_validate(data)  # pydantic v2
 
     @classmethod
-    def from_orm_object(cls, obj):
-        object_dict = {}
-        for field in obj.__table__.columns:
-            object_dict[field.name] = getattr(obj, field.name)
-        spec = object_dict.pop("spec", {})
+    def from_orm_object(cls, obj, columns=None):
+        columns = columns or _orm_columns(type(obj))
+        object_dict = {name: getattr(obj, name) for name in columns}
+        spec = object_dict.pop("spec", None) or {}
         object_dict.update(spec)
         if obj.labels:
             object_dict["labels"] = {label.name: label.value for label in obj.labels}
-        return cls.from_dict(object_dict)
+        return cls.from_dict(object_dict, trusted=True)
 
     def merge_into_orm_object(self, orm_object):
         struct = self.to_dict(drop_none=True)
-        spec = orm_object.spec or {}
+        spec = dict(orm_object.spec or {})
         labels = struct.pop("labels", None)
         for k, v in struct.items():
-            if k in (metadata_fields + self._top_level_fields) and k not in [
-                "created",
-                "updated",
-            ]:
+            if k in self._persisted_set:
                 setattr(orm_object, k, v)
-            if k not in [metadata_fields + self._top_level_fields]:
+            elif k not in self._non_spec_set:
                 spec[k] = v
+        # spec is a plain JSON column (no mutation tracking), assign a new dict so the
+        # change is detected, in place edits need flag_modified(orm_object, "spec")
         orm_object.spec = spec
 
         if labels:
-            old = {label.name: label for label in orm_object.labels}
-            orm_object.labels.clear()
-            for name, value in labels.items():
-                if name in old:
-                    if value is not None:  # None means delete
-                        old[name].value = value
-                        orm_object.labels.append(old[name])
-                else:
-                    orm_object.labels.append(
-                        orm_object.Label(name=name, value=value, parent=orm_object.name)
-                    )
+            update_labels(orm_object, labels)
 
         return orm_object
 
     def to_orm_object(self, obj_class):
         struct = self.to_dict(drop_none=False, short=False)
-        obj_dict = {
-            k: v
-            for k, v in struct.items()
-            if k in (metadata_fields + self._top_level_fields)
-            and k not in ["created", "updated"]
-        }
+        obj_dict = {k: v for k, v in struct.items() if k in self._persisted_set}
         obj_dict["spec"] = {
-            k: v
-            for k, v in struct.items()
-            if k not in metadata_fields + self._top_level_fields
+            k: v for k, v in struct.items() if k not in self._non_spec_set
         }
         labels = obj_dict.pop("labels", None)
         obj = obj_class(**obj_dict)
         if labels:
-            obj.labels.clear()
-            for name, value in labels.items():
-                obj.labels.append(obj.Label(name=name, value=value, parent=obj.name))
+            update_labels(obj, labels)
         return obj
 
     def to_yaml(self, drop_none=True):
@@ -214,6 +251,16 @@ class Base(BaseModel):
         return str(self.to_dict(to_datestr=True))
 
 
+def _model_to_dict(value):
+    if isinstance(value, list):
+        return [_model_to_dict(item) for item in value]
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
 class BaseWithMetadata(Base):
     name: str
     description: Optional[str] = None
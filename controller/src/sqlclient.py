@@ -13,10 +13,16 @@
 # limitations under the License.
 
 import datetime
+import threading
+from collections import defaultdict
 from typing import Union
 
+import orjson
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker
+from cachetools import TTLCache
+from sqlalchemy.orm import (joinedload, load_only, raiseload, selectinload,
+                            sessionmaker)
+from sqlalchemy.pool import StaticPool
 
 from controller.src import model
 from controller.src.model import ApiResponse
@@ -25,16 +31,70 @@ from controller.src.config import config, logger
 from controller.src.sqldb import Base, ChatSessionContext, DocumentCollection, User
 
 
+def _is_sqlite_memory(db_url: str) -> bool:
+    return db_url in ("sqlite://", "sqlite:///") or ":memory:" in db_url
+
+
+def _json_serializer(obj) -> str:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside a writer, NORMAL sync is safe in WAL mode
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+_LIST_CHUNK_SIZE = 200
+
+
 class SqlClient:
-    def __init__(self, db_url: str, verbose: bool = False):
+    def __init__(
+        self,
+        db_url: str,
+        verbose: bool = False,
+        pool_size: int = 10,
+        max_overflow: int = 20,
+        pool_recycle: int = 1800,
+        pool_pre_ping: bool = True,
+    ):
         self.db_url = db_url
+        self.verbose = verbose
+        engine_args = {}
+        if db_url.startswith("sqlite"):
+            engine_args["connect_args"] = {"check_same_thread": False}
+        if db_url.startswith("sqlite") and _is_sqlite_memory(db_url):
+            # in-memory sqlite lives in a single connection, share it across threads
+            engine_args["poolclass"] = StaticPool
+        else:
+            engine_args.update(
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_recycle=pool_recycle,
+                pool_pre_ping=pool_pre_ping,
+            )
         self.engine = sqlalchemy.create_engine(
-            db_url, echo=verbose, connect_args={"check_same_thread": False}
+            db_url,
+            echo=verbose,
+            echo_pool=verbose,
+            json_serializer=_json_serializer,
+            json_deserializer=orjson.loads,
+            **engine_args,
         )
+        if db_url.startswith("sqlite"):
+            sqlalchemy.event.listen(self.engine, "connect", _set_sqlite_pragmas)
         self._session_maker = sessionmaker(bind=self.engine)
         self._local_maker = sessionmaker(
             autocommit=False, autoflush=False, bind=self.engine
         )
+        # short-lived cache for single object reads, invalidated on every write
+        self._get_cache = TTLCache(maxsize=1024, ttl=30)
+        self._cache_lock = threading.Lock()
+        # bumped on every invalidation, a read only fills the cache if its class
+        # generation didn't change while it was querying (avoid caching stale rows)
+        self._cache_generation = defaultdict(int)
 
     def get_db_session(self, session: sqlalchemy.orm.Session = None):
         return session or self._session_maker()
@@ -48,19 +108,36 @@ class SqlClient:
             tables = [Base.metadata.tables[name] for name in names]
         if drop_old:
             Base.metadata.drop_all(self.engine, tables=tables)
+            with self._cache_lock:
+                self._get_cache.clear()
+                for mapper in Base.registry.mappers:
+                    self._cache_generation[mapper.class_.__name__] += 1
         Base.metadata.create_all(self.engine, tables=tables, checkfirst=True)
         return ApiResponse(success=True)
 
+    def _invalidate_cache(self, db_class):
+        with self._cache_lock:
+            self._cache_generation[db_class.__name__] += 1
+            for key in [k for k in self._get_cache.keys() if k[0] == db_class.__name__]:
+                self._get_cache.pop(key, None)
+
     def _update(self, session: sqlalchemy.orm.Session, db_class, api_object, **kwargs):
         session = self.get_db_session(session)
-        obj = session.query(db_class).filter_by(**kwargs).one_or_none()
+        obj = (
+            session.query(db_class)
+            .options(joinedload(db_class.labels))
+            .filter_by(**kwargs)
+            .one_or_none()
+        )
         if obj:
             api_object.merge_into_orm_object(obj)
             session.add(obj)
+            # build the response before the commit expires the object (avoid re-select)
+            session.flush()
+            data = api_object.__class__.from_orm_object(obj)
             session.commit()
-            return ApiResponse(
-                success=True, data=api_object.__class__.from_orm_object(obj)
-            )
+            self._invalidate_cache(db_class)
+            return ApiResponse(success=True, data=data)
         else:
             return ApiResponse(
                 success=False, error=f"{db_class} object ({kwargs}) not found"
@@ -68,34 +145,107 @@ class SqlClient:
 
     def _delete(self, session: sqlalchemy.orm.Session, db_class, **kwargs):
         session = self.get_db_session(session)
-        query = session.query(db_class).filter_by(**kwargs)
-        for obj in query:
-            session.delete(obj)
+        # delete the labels and then the objects, two statements for any number of rows
+        # (don't rely on ON DELETE CASCADE, sqlite doesn't enforce foreign keys)
+        names = sqlalchemy.select(db_class.name).filter_by(**kwargs)
+        session.execute(
+            sqlalchemy.delete(db_class.Label).where(db_class.Label.parent.in_(names))
+        )
+        session.query(db_class).filter_by(**kwargs).delete(synchronize_session=False)
         session.commit()
+        self._invalidate_cache(db_class)
         return ApiResponse(success=True)
 
     def _get(self, session: sqlalchemy.orm.Session, db_class, api_class, **kwargs):
+        cache_key = (db_class.__name__, tuple(sorted(kwargs.items())))
+        with self._cache_lock:
+            cached = self._get_cache.get(cache_key)
+            generation = self._cache_generation[db_class.__name__]
+        if cached is not None:
+            # return a copy so callers can't mutate the cached object
+            return ApiResponse(success=True, data=cached.copy(deep=True))
+
         session = self.get_db_session(session)
-        obj = session.query(db_class).filter_by(**kwargs).one_or_none()
+        obj = (
+            session.query(db_class)
+            .options(joinedload(db_class.labels))
+            .filter_by(**kwargs)
+            .one_or_none()
+        )
         if obj is None:
             return ApiResponse(
                 success=False, error=f"{db_class} object ({kwargs}) not found"
             )
-        return ApiResponse(success=True, data=api_class.from_orm_object(obj))
+        data = api_class.from_orm_object(obj)
+        with self._cache_lock:
+            if generation == self._cache_generation[db_class.__name__]:
+                self._get_cache[cache_key] = data.copy(deep=True)
+        return ApiResponse(success=True, data=data)
+
+    def _list(
+        self,
+        session: sqlalchemy.orm.Session,
+        db_class,
+        api_class,
+        output_mode: model.OutputMode,
+        filters: list = None,
+        order_by=None,
+        limit: int = 0,
+        offset: int = 0,
+    ):
+        session = self.get_db_session(session)
+        columns = None
+        if output_mode == model.OutputMode.Names:
+            # only the names are returned, don't load the full objects
+            query = session.query(db_class.name)
+        else:
+            # load the labels of all the rows in a single IN query (avoid N+1 selects)
+            query = session.query(db_class).options(selectinload(db_class.labels))
+            if self.verbose:
+                # fail loudly on any other lazy load so N+1 regressions are caught
+                query = query.options(raiseload("*", sql_only=True))
+            if (
+                output_mode == model.OutputMode.Short
+                and not api_class._short_spec_fields
+            ):
+                # the short view has no spec fields, skip fetching the spec column
+                columns = [
+                    c.name for c in db_class.__table__.columns if c.name != "spec"
+                ]
+                query = query.options(
+                    load_only(*[getattr(db_class, name) for name in columns])
+                )
+        for condition in filters or []:
+            query = query.filter(condition)
+        if order_by is not None:
+            query = query.order_by(order_by)
+        if limit > 0:
+            query = query.limit(limit)
+        if offset > 0:
+            query = query.offset(offset)
+        # stream the rows in chunks instead of materializing the full result set
+        query = query.yield_per(_LIST_CHUNK_SIZE)
+        data = _process_output(query, api_class, output_mode, columns)
+        return ApiResponse(success=True, data=data)
 
     def _create(self, session: sqlalchemy.orm.Session, db_class, obj):
         session = self.get_db_session(session)
         try:
             db_object = obj.to_orm_object(db_class)
             session.add(db_object)
+            session.flush()
+            data = obj.__class__.from_orm_object(db_object)
             session.commit()
-            return ApiResponse(
-                success=True, data=obj.__class__.from_orm_object(db_object)
-            )
-        except sqlalchemy.exc.IntegrityError:
-            return ApiResponse(
-                success=False, error=f"{db_class} {obj.name} already exists"
-            )
+            self._invalidate_cache(db_class)
+            return ApiResponse(success=True, data=data)
+        except sqlalchemy.exc.IntegrityError as exc:
+            session.rollback()
+            if session.query(db_class.name).filter_by(name=obj.name).first():
+                error = f"{db_class} {obj.name} already exists"
+            else:
+                # e.g. a missing referenced object (owner/user) or another unique column
+                error = f"{db_class} {obj.name} violates a constraint: {exc.orig}"
+            return ApiResponse(success=False, error=error)
 
     def get_user(self, username: str, session: sqlalchemy.orm.Session = None):
         logger.debug(f"Getting user: username={username}")
@@ -121,18 +271,27 @@ class SqlClient:
         labels_match: Union[list, str] = None,
         output_mode: model.OutputMode = model.OutputMode.Details,
         session: sqlalchemy.orm.Session = None,
+        limit: int = 0,
+        offset: int = 0,
     ):
         logger.debug(
             f"Getting users: full_name~={full_name}, email={email}, mode={output_mode}"
         )
-        session = self.get_db_session(session)
-        query = session.query(User)
+        filters = []
         if email:
-            query = query.filter(User.email == email)
+            filters.append(User.email == email)
         if full_name:
-            query = query.filter(User.full_name.like(f"%{full_name}%"))
-        data = _process_output(query.all(), model.User, output_mode)
-        return ApiResponse(success=True, data=data)
+            filters.append(User.full_name.like(f"%{full_name}%"))
+        return self._list(
+            session,
+            User,
+            model.User,
+            output_mode,
+            filters,
+            order_by=User.name,
+            limit=limit,
+            offset=offset,
+        )
 
     def get_collection(self, name: str, session: sqlalchemy.orm.Session = None):
         logger.debug(f"Getting collection: name={name}")
@@ -170,14 +329,14 @@ class SqlClient:
         logger.debug(
             f"Getting collections: owner={owner}, labels_match={labels_match}, mode={output_mode}"
         )
-        session = self.get_db_session(session)
-        query = session.query(DocumentCollection)
+        filters = []
         if owner:
-            query = query.filter(DocumentCollection.owner_name == owner)
+            filters.append(DocumentCollection.owner_name == owner)
         if labels_match:
             pass
-        data = _process_output(query.all(), model.DocCollection, output_mode)
-        return ApiResponse(success=True, data=data)
+        return self._list(
+            session, DocumentCollection, model.DocCollection, output_mode, filters
+        )
 
     def get_session(
         self,
@@ -229,25 +388,30 @@ class SqlClient:
         last=0,
         output_mode: model.OutputMode = model.OutputMode.Details,
         session: sqlalchemy.orm.Session = None,
+        offset: int = 0,
     ):
         logger.debug(
             f"Getting chat sessions: username={username}, created>{created_after}, last={last}, mode={output_mode}"
         )
-        session = self.get_db_session(session)
-        query = session.query(ChatSessionContext)
+        filters = []
         if username:
-            query = query.filter(ChatSessionContext.username == username)
+            filters.append(ChatSessionContext.username == username)
         if created_after:
             if isinstance(created_after, str):
                 created_after = datetime.datetime.strptime(
                     created_after, "%Y-%m-%d %H:%M"
                 )
-            query = query.filter(ChatSessionContext.created >= created_after)
-        query = query.order_by(ChatSessionContext.updated.desc())
-        if last > 0:
-            query = query.limit(last)
-        data = _process_output(query.all(), model.ChatSession, output_mode)
-        return ApiResponse(success=True, data=data)
+            filters.append(ChatSessionContext.created >= created_after)
+        return self._list(
+            session,
+            ChatSessionContext,
+            model.ChatSession,
+            output_mode,
+            filters,
+            order_by=ChatSessionContext.updated.desc(),
+            limit=last,
+            offset=offset,
+        )
 
 
 def _dict_to_object(cls, d):
@@ -257,15 +421,19 @@ def _dict_to_object(cls, d):
 
 
 def _process_output(
-    items, obj_class, mode: model.OutputMode = model.OutputMode.Details
+    items, obj_class, mode: model.OutputMode = model.OutputMode.Details, columns=None
 ):
     if mode == model.OutputMode.Names:
         return [item.name for item in items]
-    items = [obj_class.from_orm_object(item) for item in items]
+    items = [obj_class.from_orm_object(item, columns) for item in items]
     if mode == model.OutputMode.Details:
         return items
     short = mode == model.OutputMode.Short
     return [item.to_dict(short=short) for item in items]
 
 
-client = SqlClient(config.sql_connection_str, verbose=config.verbose)
+client = SqlClient(
+    config.sql_connection_str,
+    verbose=config.verbose,
+    pool_size=config.sql_pool_size,
+)
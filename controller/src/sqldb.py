@@ -12,109 +12,204 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import datetime
+from itertools import islice
 
 import sqlalchemy
 from sqlalchemy import (JSON, Column, DateTime, ForeignKey, Index, Integer,
-                        String, UniqueConstraint)
-from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.orm import declarative_base, relationship
+                        String, Text, UniqueConstraint)
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import configure_mappers, declarative_base, relationship
+from sqlalchemy.sql.expression import FunctionElement
 
 # Create a base class for declarative class definitions
 Base = declarative_base()
 
 
-def make_label(table):
-    class Label(Base):
-        __tablename__ = f"{table}_labels"
-        __table_args__ = (
-            UniqueConstraint("name", "parent", name=f"_{table}_labels_uc"),
-            Index(f"idx_{table}_labels_name_value", "name", "value"),
-        )
+class utcnow(FunctionElement):
+    """Current UTC time, evaluated by the database instead of in Python.
+
+    Compiled per dialect, other dialects fall back to CURRENT_TIMESTAMP which is only
+    UTC when the database session time zone is UTC.
+    """
+
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def _default_utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, "sqlite")
+def _sqlite_utcnow(element, compiler, **kw):
+    # keep sub-second precision, CURRENT_TIMESTAMP only has seconds in sqlite
+    return "STRFTIME('%Y-%m-%d %H:%M:%f', 'now')"
+
 
-        id = Column(Integer, primary_key=True)
-        name = Column(String(255, None))  # in mysql collation="utf8_bin"
-        value = Column(String(255, collation=None))
-        parent = Column(Integer, ForeignKey(f"{table}.name"))
+@compiles(utcnow, "mysql")
+def _mysql_utcnow(element, compiler, **kw):
+    # CURRENT_TIMESTAMP is in the session time zone in mysql, the parentheses make it
+    # a valid expression column default (requires mysql 8.0.13+)
+    return "(UTC_TIMESTAMP())"
 
-    return Label
+
+# the timestamps are computed by the database: default=utcnow() is rendered inline in
+# the INSERT (tables created before the server defaults don't have them in their DDL)
+# and eager_defaults fetches the values in the INSERT/UPDATE itself (RETURNING). mysql
+# has no RETURNING and gets a SELECT after the flush instead, the responses read the
+# timestamps right after the flush so that SELECT would be emitted there anyway
+_mapper_args = {"eager_defaults": True}
+
+
+def make_label(table):
+    """Create the labels table and mapped class for the given parent table.
+
+    Each parent keeps its own labels table so the parent key stays a real foreign
+    key. The class gets a unique name to keep the declarative registry unambiguous.
+    """
+    class_name = "".join(part.title() for part in table.split("_")) + "Label"
+    return type(
+        class_name,
+        (Base,),
+        {
+            "__tablename__": f"{table}_labels",
+            "__table_args__": (
+                UniqueConstraint("parent", "name", name=f"_{table}_labels_uc"),
+                Index(f"idx_{table}_labels_name_value", "name", "value"),
+            ),
+            "id": Column(Integer, primary_key=True),
+            "name": Column(String(255, None)),  # in mysql collation="utf8_bin"
+            "value": Column(String(255, collation=None)),
+            "parent": Column(
+                String(255), ForeignKey(f"{table}.name", ondelete="CASCADE")
+            ),
+        },
+    )
 
 
 def update_labels(obj, labels: dict):
+    """Update the object labels in place, only touching the labels that changed.
+
+    Labels missing from the new labels dict or set to None are deleted.
+    """
     old = {label.name: label for label in obj.labels}
-    obj.labels.clear()
-    for name, value in labels.items():
-        if name in old:
-            old[name].value = value
-            obj.labels.append(old[name])
-        else:
-            obj.labels.append(obj.Label(name=name, value=value, parent=obj.name))
+    for name, label in old.items():
+        value = labels.get(name)
+        if value is None:
+            obj.labels.remove(label)
+        elif label.value != value:
+            label.value = value
+    obj.labels.extend(
+        obj.Label(name=name, value=value, parent=obj.name)
+        for name, value in labels.items()
+        if name not in old and value is not None
+    )
+
+
+def bulk_insert(session, db_class, rows, chunk_size: int = 1000):
+    """Insert many rows (dicts of column values) without building ORM objects.
+
+    Each chunk is a single executemany of one INSERT statement (a DBAPI executemany on
+    sqlite, batched into multi-row INSERTs on drivers with insertmanyvalues support).
+    Labels and relationships are not handled, use ORM objects for those.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, chunk_size))
+        if not batch:
+            break
+        session.execute(sqlalchemy.insert(db_class), batch)
 
 
 class User(Base):
     __tablename__ = "users"
+    __mapper_args__ = _mapper_args
 
     name = Column(String(255), primary_key=True, nullable=False)
     email = Column(String(255), nullable=False, unique=True)
-    description = Column(String(255), nullable=True, default="")
+    description = Column(Text, nullable=True, default="")
     full_name = Column(String(255), nullable=False)
-    created = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    created = Column(
+        DateTime, default=utcnow(), server_default=utcnow(), nullable=False
+    )
     updated = Column(
         DateTime,
-        default=datetime.datetime.utcnow,
-        onupdate=datetime.datetime.utcnow,
+        default=utcnow(),
+        server_default=utcnow(),
+        onupdate=utcnow(),
         nullable=False,
     )
-    spec = Column(MutableDict.as_mutable(JSON), nullable=True)
+    spec = Column(JSON, nullable=True)
     Label = make_label(__tablename__)
-    labels = relationship(Label, cascade="all, delete-orphan")
+    labels = relationship(
+        Label, cascade="all, delete-orphan", passive_deletes=True, lazy="selectin"
+    )
 
 
 class ChatSessionContext(Base):
     """Chat session context table CRUD"""
 
     __tablename__ = "session_context"
+    __mapper_args__ = _mapper_args
+    __table_args__ = (
+        Index("idx_session_context_username_updated", "username", "updated"),
+    )
 
     name = Column(String(255), primary_key=True, nullable=False)
-    description = Column(String(255), nullable=True, default="")
+    description = Column(Text, nullable=True, default="")
     username = Column(String(255), sqlalchemy.ForeignKey("users.name"), nullable=False)
-    created = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    created = Column(
+        DateTime, default=utcnow(), server_default=utcnow(), nullable=False
+    )
     updated = Column(
         DateTime,
-        default=datetime.datetime.utcnow,
-        onupdate=datetime.datetime.utcnow,
+        default=utcnow(),
+        server_default=utcnow(),
+        onupdate=utcnow(),
         nullable=False,
     )
-    spec = Column(MutableDict.as_mutable(JSON), nullable=True)
+    spec = Column(JSON, nullable=True)
     Label = make_label(__tablename__)
-    labels = relationship(Label, cascade="all, delete-orphan")
+    labels = relationship(
+        Label, cascade="all, delete-orphan", passive_deletes=True, lazy="selectin"
+    )
 
     # Define the relationship with the 'Users' table
-    user = relationship(User)
+    user = relationship(User, lazy="raise_on_sql")
 
 
 class DocumentCollection(Base):
     __tablename__ = "document_collections"
+    __mapper_args__ = _mapper_args
+    __table_args__ = (Index("idx_document_collections_owner", "owner_name"),)
 
     name = Column(String(255), primary_key=True, nullable=False)
-    description = Column(String(255), nullable=True, default="")
-    created = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    description = Column(Text, nullable=True, default="")
+    created = Column(
+        DateTime, default=utcnow(), server_default=utcnow(), nullable=False
+    )
     updated = Column(
         DateTime,
-        default=datetime.datetime.utcnow,
-        onupdate=datetime.datetime.utcnow,
+        default=utcnow(),
+        server_default=utcnow(),
+        onupdate=utcnow(),
         nullable=False,
     )
-    spec = Column(MutableDict.as_mutable(JSON), nullable=True)
+    spec = Column(JSON, nullable=True)
     Label = make_label(__tablename__)
-    labels = relationship(Label, cascade="all, delete-orphan")
+    labels = relationship(
+        Label, cascade="all, delete-orphan", passive_deletes=True, lazy="selectin"
+    )
     owner_name = Column(String(255), sqlalchemy.ForeignKey("users.name"), nullable=True)
 
-    owner = relationship(User)
+    owner = relationship(User, lazy="raise_on_sql")
 
 
 class Document(Base):
     __tablename__ = "documents"
+    __mapper_args__ = _mapper_args
+    __table_args__ = (Index("idx_documents_collection", "collection_name"),)
     _details_fields = ["doc_origin", "meta"]
 
     doc_uid = Column(String(255), primary_key=True, nullable=False)
@@ -123,74 +218,47 @@ class Document(Base):
         String(255), sqlalchemy.ForeignKey("document_collections.name"), nullable=False
     )
     title = Column(String(255), nullable=True)
-    source = Column(String(255), nullable=True)
+    source = Column(Text, nullable=True)
     doc_origin = Column(String(255), nullable=True)
     num_chunks = Column(Integer, nullable=True)
-    created_time = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    created_time = Column(
+        DateTime, default=utcnow(), server_default=utcnow(), nullable=False
+    )
     last_update = Column(
         DateTime,
-        default=datetime.datetime.utcnow,
-        onupdate=datetime.datetime.utcnow,
+        default=utcnow(),
+        server_default=utcnow(),
+        onupdate=utcnow(),
         nullable=False,
     )
     meta = Column(JSON, nullable=True)
 
-    collection = relationship(DocumentCollection)
-
-    def __init__(
-        self,
-        doc_uid,
-        version,
-        collection_name,
-        title,
-        source,
-        doc_origin=None,
-        num_chunks=None,
-        meta=None,
-    ):
-        self.doc_uid = doc_uid
-        self.version = version
-        self.collection_name = collection_name
-        self.title = title
-        self.source = source
-        self.doc_origin = doc_origin
-        self.num_chunks = num_chunks
-        self.meta = meta
+    collection = relationship(DocumentCollection, lazy="raise_on_sql")
 
 
 class Prompt(Base):
     __tablename__ = "prompts"
+    __mapper_args__ = _mapper_args
     _details_fields = ["arguments", "meta"]
 
     name = Column(String(255), primary_key=True, nullable=False)
     version = Column(String(255), primary_key=True, nullable=False)
-    description = Column(String(255), nullable=True)
-    text = Column(String(255), nullable=True)
+    description = Column(Text, nullable=True)
+    text = Column(Text, nullable=True)
     arguments = Column(JSON, nullable=True)
     meta = Column(JSON, nullable=True)
-    created_time = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    created_time = Column(
+        DateTime, default=utcnow(), server_default=utcnow(), nullable=False
+    )
     last_update = Column(
         DateTime,
-        default=datetime.datetime.utcnow,
-        onupdate=datetime.datetime.utcnow,
+        default=utcnow(),
+        server_default=utcnow(),
+        onupdate=utcnow(),
         nullable=False,
     )
     usage = Column(JSON, nullable=True)
 
-    def __init__(
-        self,
-        name,
-        version,
-        description=None,
-        text=None,
-        arguments=None,
-        meta=None,
-        usage=None,
-    ):
-        self.name = name
-        self.version = version
-        self.description = description
-        self.text = text
-        self.arguments = arguments
-        self.meta = meta
-        self.usage = usage
+
+# configure the mappers at import time, so the first request doesn't pay for it
+configure_mappers()
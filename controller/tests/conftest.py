@@ -0,0 +1,69 @@
+# Copyright 2023 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from contextlib import contextmanager
+
+import pytest
+import sqlalchemy
+
+from controller.src import model
+from controller.src.sqlclient import SqlClient
+
+NUM_USERS = 20
+
+
+@pytest.fixture
+def num_users():
+    """Number of users (each with one chat session) created by the client fixture."""
+    return NUM_USERS
+
+
+@pytest.fixture
+def client(tmp_path):
+    """SQL client on a fresh sqlite file, with users (and labels) and sessions."""
+    client = SqlClient(f"sqlite:///{tmp_path}/sql.db")
+    client.create_tables(drop_old=True)
+    for i in range(NUM_USERS):
+        user = model.User(
+            name=f"user{i}",
+            email=f"user{i}@example.com",
+            full_name=f"User {i}",
+            labels={"team": "a", "index": str(i)},
+        )
+        assert client.create_user(user).success
+        chat_session = model.ChatSession(name=f"session{i}", username=f"user{i}")
+        assert client.create_session(chat_session).success
+    yield client
+    client.engine.dispose()
+
+
+@pytest.fixture
+def max_queries(client):
+    """Assert that the code in the with block runs at most `limit` SQL statements."""
+
+    @contextmanager
+    def _max_queries(limit: int):
+        statements = []
+
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(client.engine, "before_cursor_execute", _count)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(client.engine, "before_cursor_execute", _count)
+        assert len(statements) <= limit, "\n".join(statements)
+
+    return _max_queries
@@ -0,0 +1,50 @@
+# Copyright 2023 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from controller.src import model
+
+
+def test_to_dict_copies_containers():
+    user = model.User(
+        name="user", email="user@example.com", labels={"a": "1"}, features={"f": "1"}
+    )
+    struct = user.to_dict()
+    struct["labels"]["b"] = "2"
+    struct["features"]["g"] = "2"
+    assert user.labels == {"a": "1"}
+    assert user.features == {"f": "1"}
+
+
+def test_to_dict_copies_trusted_history():
+    history = [{"role": "Human", "content": "hi"}]
+    chat_session = model.ChatSession.from_dict(
+        {"name": "session", "history": history}, trusted=True
+    )
+    struct = chat_session.to_dict()
+    struct["history"][0]["content"] = "changed"
+    struct["history"].append({"role": "AI", "content": "hello"})
+    assert chat_session.history == [{"role": "Human", "content": "hi"}]
+
+
+def test_conversation_from_list():
+    conversation = model.Conversation.from_list(
+        [{"role": "Human", "content": "hi", "unknown": 1}]
+    )
+    message = conversation.messages[0]
+    assert message.role is model.ChatRole.Human
+    assert message.content == "hi"
+    assert not hasattr(message, "unknown")
+    assert conversation.to_list() == [
+        model.Message(role=model.ChatRole.Human, content="hi").dict()
+    ]
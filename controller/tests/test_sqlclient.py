@@ -0,0 +1,135 @@
+# Copyright 2023 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from controller.src import model, sqldb
+
+
+@pytest.mark.parametrize(
+    "output_mode, queries",
+    [
+        (model.OutputMode.Names, 1),
+        (model.OutputMode.Short, 2),
+        (model.OutputMode.Dict, 2),
+        (model.OutputMode.Details, 2),
+    ],
+)
+def test_list_users_query_count(client, max_queries, num_users, output_mode, queries):
+    # the labels of all the users are loaded in one query, not one per user
+    with max_queries(queries):
+        users = client.list_users(output_mode=output_mode).with_raise().data
+    assert len(users) == num_users
+    if output_mode == model.OutputMode.Details:
+        assert all(user.labels["team"] == "a" for user in users)
+
+
+def test_list_users_paging(client):
+    names = client.list_users(output_mode=model.OutputMode.Names).data
+    page = client.list_users(output_mode=model.OutputMode.Names, limit=5, offset=5)
+    assert page.data == names[5:10]
+
+
+def test_list_sessions_query_count(client, max_queries):
+    with max_queries(2):
+        sessions = client.list_sessions(username="user3", last=1).with_raise().data
+    assert [chat_session.name for chat_session in sessions] == ["session3"]
+
+
+def test_get_session_query_count(client, max_queries):
+    with max_queries(1):
+        chat_session = client.get_session("session1").with_raise().data
+    assert chat_session.username == "user1"
+    # served from the cache
+    with max_queries(0):
+        client.get_session("session1").with_raise()
+
+
+def test_update_session_history(client):
+    chat_session = client.get_session("session1").data
+    chat_session.history = [model.Message(role=model.ChatRole.Human, content="hi")]
+    client.update_session(chat_session).with_raise()
+    conversation = client.get_session("session1").data.to_conversation()
+    assert [message.content for message in conversation.messages] == ["hi"]
+
+
+def test_get_cache_invalidated_on_update(client):
+    assert client.get_user("user1").data.full_name == "User 1"
+    user = model.User(name="user1", email="user1@example.com", full_name="New")
+    client.update_user(user).with_raise()
+    assert client.get_user("user1").data.full_name == "New"
+
+
+def test_get_does_not_cache_a_stale_read(client, monkeypatch):
+    from_orm_object = model.User.from_orm_object.__func__
+
+    def racing_from_orm_object(cls, obj, columns=None):
+        # an update commits after the read, before the result is cached
+        data = from_orm_object(cls, obj, columns)
+        monkeypatch.undo()
+        user = model.User(name="user1", email="user1@example.com", full_name="New")
+        client.update_user(user).with_raise()
+        return data
+
+    monkeypatch.setattr(
+        model.User, "from_orm_object", classmethod(racing_from_orm_object)
+    )
+    assert client.get_user("user1").data.full_name == "User 1"
+    assert client.get_user("user1").data.full_name == "New"
+
+
+def test_update_labels(client):
+    labels = {"team": "b", "index": None, "new": "x"}
+    user = model.User(name="user1", email="user1@example.com", labels=labels)
+    data = client.update_user(user).with_raise().data
+    assert data.labels == {"team": "b", "new": "x"}
+    assert client.get_user("user1").data.labels == {"team": "b", "new": "x"}
+
+
+def test_delete_removes_labels(client, max_queries, num_users):
+    # the labels and the user are deleted with one statement each
+    with max_queries(2):
+        client.delete_user("user1").with_raise()
+    assert not client.get_user("user1").success
+    db_session = client.get_local_session()
+    labels = db_session.query(sqldb.User.Label).filter_by(parent="user1").count()
+    assert labels == 0
+    assert db_session.query(sqldb.User.Label).count() == 2 * (num_users - 1)
+
+
+def test_create_errors(client):
+    user = model.User(name="user1", email="other@example.com")
+    assert "already exists" in client.create_user(user).error
+    user = model.User(name="other", email="user1@example.com", full_name="Other")
+    response = client.create_user(user)
+    assert not response.success
+    assert "already exists" not in response.error
+
+
+def test_bulk_insert(client, max_queries):
+    db_session = client.get_local_session()
+    db_session.add(sqldb.DocumentCollection(name="docs"))
+    db_session.flush()
+    rows = (
+        {"doc_uid": f"doc{i}", "version": "1", "collection_name": "docs"}
+        for i in range(25)
+    )
+    # one statement per chunk, not per row
+    with max_queries(3) as statements:
+        sqldb.bulk_insert(db_session, sqldb.Document, rows, chunk_size=10)
+    assert len(statements) == 3
+    db_session.commit()
+    documents = db_session.query(sqldb.Document).order_by(sqldb.Document.doc_uid)
+    assert documents.count() == 25
+    assert all(document.created_time for document in documents)